@@ -11,9 +11,19 @@ Description : This file contains a class that implements a Inet-domain TCP
 from encodings import utf_8
 import socket
 import sys
+import os
+import errno
 import ctypes as ct
 import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Capacity requested for the pipe used to splice socket data into files (1 MiB)
+SPLICE_PIPE_SIZE = 1024 * 1024
+
+# splice() errors meaning the socket or the file does not support it
+SPLICE_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS)
 
 
 class BufferInfo(ct.Structure):
@@ -24,10 +34,6 @@ class BufferInfo(ct.Structure):
         ("last_packet_size", ct.c_int)
     ]
 
-    def get_dict(self):
-        """Convert to dictionary"""
-        return dict((f, getattr(self, f)) for f, _ in self._fields_)
-
 
 class ServerSocketTCP:
     """Its a TCP inet socket"""
@@ -40,43 +46,168 @@ class ServerSocketTCP:
         # Create a TCP socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        # Allow restarting the server right after a previous run. SO_RCVBUF
+        # is deliberately not set: on Linux it locks the receive buffer and
+        # disables TCP receive autotuning, which grows it up to tcp_rmem[2]
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
         # Bind the socket to the address
         self.socket.bind(self.server_address)
 
         # Listening for incomming connections
         self.socket.listen(1)
 
+        # Receive buffers reused across transfers (grown on demand). Two
+        # buffers are alternated so one can be written to disk while the
+        # next transfer is received into the other
+        self._rx_bufs = [bytearray(), bytearray()]
+        self._rx_index = 0
+
+        # BufferInfo reused across transfers (a zero-copy view of its own buffer)
+        self._info_buf = bytearray(ct.sizeof(BufferInfo))
+        self._info = BufferInfo.from_buffer(self._info_buf)
+
+        # Pipe used to move received data into files without copying it to
+        # user space (splice() is only available on Linux)
+        self._pipe = None
+        if hasattr(os, "splice"):
+            import fcntl
+            self._pipe = os.pipe()
+            try:
+                fcntl.fcntl(self._pipe[1], fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+            except OSError:
+                pass
+            self._pipe_size = fcntl.fcntl(self._pipe[1], fcntl.F_GETPIPE_SZ)
+
+    def can_splice(self):
+        """whether received data can be moved to files with recv_into_file()"""
+        return self._pipe is not None
+
     def wait_connection(self):
         """wait for the client to connect"""
         # Wait for a client to connect
         self.connection, self.client_address = self.socket.accept()
 
+    def recv_buffer_size(self):
+        """get the current kernel receive buffer size of the connection"""
+        return self.connection.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
     def recv_data(self, input_size):
         """get data from client.
            This function ensures input_size bytes are read, since socket.recv()
-           does not guarantee it reads the number of bytes you demand."""
+           does not guarantee it reads the number of bytes you demand.
+           Meant for small control messages, bulk data should be received with
+           recv_into_exact() to avoid allocating intermediate objects."""
+
+        data_out = bytearray(input_size)
+        self.recv_into_exact(memoryview(data_out))
+
+        return bytes(data_out)
 
-        # Internal variables used to ensure all input_size is read
+    def recv_into_exact(self, buffer):
+        """get data from client directly into a writable buffer.
+           This function ensures the whole buffer (a memoryview) is filled,
+           writing the received bytes straight into the caller's memory."""
+
+        # Internal variables used to ensure the whole buffer is filled
         num_bytes_recv = 0
-        data_out = bytes()
+        input_size = len(buffer)
 
         # Read until input_size bytes are received
         while (num_bytes_recv < input_size):
 
-            # Read from socket the remaining number of bytes to be read
-            data_aux = self.connection.recv(input_size - num_bytes_recv)
+            # Read from socket the remaining bytes into the unfilled region
+            num_bytes_aux = self.connection.recv_into(buffer[num_bytes_recv:])
 
             # Check if the connection is broken
-            if data_aux == b'':
+            if num_bytes_aux == 0:
                 raise RuntimeError("socket connection broken")
 
-            # Append read data to previously read data
-            data_out += data_aux
-
             # Calculate how many bytes are left to be read
-            num_bytes_recv = len(data_out)
+            num_bytes_recv += num_bytes_aux
+
+    def recv_exact_into_reused(self, input_size):
+        """get input_size bytes from client into one of the reused receive buffers.
+           A buffer is only reallocated when it is smaller than input_size.
+           The two buffers are used alternately, so the returned memoryview
+           is valid until the call after the next one."""
+
+        # Grow the reused buffer when the incoming data does not fit
+        if len(self._rx_bufs[self._rx_index]) < input_size:
+            self._rx_bufs[self._rx_index] = bytearray(input_size)
+
+        data_view = memoryview(self._rx_bufs[self._rx_index])[:input_size]
+        self._rx_index ^= 1
+        self.recv_into_exact(data_view)
+
+        return data_view
+
+    def recv_buffer_info(self):
+        """get the BufferInfo describing the next buffer sent by the client.
+           The returned struct is reused, its fields are only valid until the
+           next call."""
+
+        self.recv_into_exact(memoryview(self._info_buf))
+
+        return self._info
 
-        return data_out
+    def recv_into_file(self, fd, input_size):
+        """get input_size bytes from client and write them to the file fd.
+           Data is spliced from the socket into a pipe and from the pipe into
+           the file, so it never leaves the kernel. Requires can_splice().
+           If splice() turns out not to be supported, it is disabled for the
+           rest of the connection and the number of bytes already written to
+           fd (less than input_size) is returned; the caller has to receive
+           the remaining bytes with recv_into_exact()."""
+
+        pipe_r, pipe_w = self._pipe
+        socket_fd = self.connection.fileno()
+
+        # Internal variable used to ensure all input_size is moved
+        num_bytes_left = input_size
+
+        # Move until input_size bytes are written to the file
+        while num_bytes_left > 0:
+
+            # Move from the socket to the pipe as much as the pipe can hold
+            try:
+                num_bytes_piped = os.splice(socket_fd, pipe_w, min(num_bytes_left, self._pipe_size))
+            except OSError as e:
+                if e.errno not in SPLICE_UNSUPPORTED_ERRNOS:
+                    raise
+                self._disable_splice()
+                return input_size - num_bytes_left
+
+            # Check if the connection is broken
+            if num_bytes_piped == 0:
+                raise RuntimeError("socket connection broken")
+
+            # Drain the pipe into the file
+            while num_bytes_piped > 0:
+                try:
+                    num_bytes_aux = os.splice(pipe_r, fd, num_bytes_piped)
+                except OSError as e:
+                    if e.errno not in SPLICE_UNSUPPORTED_ERRNOS:
+                        raise
+                    # Recover the data left in the pipe through user space
+                    while num_bytes_piped > 0:
+                        data = os.read(pipe_r, num_bytes_piped)
+                        write_all(fd, data)
+                        num_bytes_piped -= len(data)
+                        num_bytes_left -= len(data)
+                    self._disable_splice()
+                    return input_size - num_bytes_left
+                num_bytes_piped -= num_bytes_aux
+                num_bytes_left -= num_bytes_aux
+
+        return input_size
+
+    def _disable_splice(self):
+        """stop using splice(), received data goes through user space from now on"""
+        print("splice() not supported, falling back to recv_into()")
+        os.close(self._pipe[0])
+        os.close(self._pipe[1])
+        self._pipe = None
 
     def recv_data_old(self, input_size):
         """get data from client"""
@@ -97,6 +228,153 @@ class ServerSocketTCP:
         print("Se está cerrando el socket")
         # Close the socket and remove the file
         self.socket.close()
+        if getattr(self, "_pipe", None) is not None:
+            os.close(self._pipe[0])
+            os.close(self._pipe[1])
+
+
+def _load_fallocate():
+    """get the Linux fallocate(2) wrapper from libc, or None if unavailable.
+       os.posix_fallocate() is not used since, on filesystems without
+       fallocate support, glibc emulates it by writing every block, which
+       would write the file twice instead of preallocating it."""
+
+    if not sys.platform.startswith("linux"):
+        return None
+
+    libc = ct.CDLL(None, use_errno=True)
+    fallocate = getattr(libc, "fallocate64", None) or getattr(libc, "fallocate", None)
+    if fallocate is not None:
+        fallocate.argtypes = [ct.c_int, ct.c_int, ct.c_int64, ct.c_int64]
+        fallocate.restype = ct.c_int
+
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
+
+def open_trace_file(path, size):
+    """open path for writing a file of the given size and return its fd.
+       The file blocks are preallocated, when the filesystem supports it."""
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    # Let the filesystem allocate the whole extent up front. This is only
+    # an optimization, on failure (e.g. EOPNOTSUPP) the file is just written
+    if _fallocate is not None and size > 0:
+        _fallocate(fd, 0, 0, size)
+
+    return fd
+
+
+def write_all(fd, data):
+    """write the whole buffer data to the file fd"""
+
+    # os.write() may write less than requested, loop until everything is written
+    num_bytes_written = 0
+    while num_bytes_written < len(data):
+        num_bytes_written += os.write(fd, data[num_bytes_written:])
+
+
+def truncate_to_written(fd):
+    """cut the file fd at its current position.
+       Used when writing fails, so a preallocated file does not keep a tail
+       of zeros that could be mistaken for trace data."""
+
+    os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+
+
+def write_to_file(path, data):
+    """write a fully assembled buffer to path.
+       The file is written with raw os.write() calls instead of through a
+       BufferedWriter, since the data is already in a single buffer."""
+
+    fd = open_trace_file(path, len(data))
+    try:
+        write_all(fd, data)
+    except BaseException:
+        truncate_to_written(fd)
+        raise
+    finally:
+        os.close(fd)
+
+
+class TraceWriter:
+    """Writes received buffers to disk in a background thread, so the disk
+       write of a buffer overlaps with the reception of the next one.
+       At most one write is in flight once write() returns, which allows the
+       two alternating receive buffers of ServerSocketTCP to be reused."""
+
+    def __init__(self):
+        """creates the writer thread"""
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_write = None
+
+    def write(self, path, data):
+        """queue data to be written to path"""
+        write_future = self._executor.submit(write_to_file, path, data)
+
+        # Wait for the previous write (raising its errors, if any)
+        self.flush()
+        self._pending_write = write_future
+
+    def flush(self):
+        """wait for the in-flight write to finish"""
+        if self._pending_write is not None:
+            pending_write, self._pending_write = self._pending_write, None
+            pending_write.result()
+
+    def close(self):
+        """wait for the in-flight write and stop the writer thread"""
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+
+def recv_buffer_to_file(conn, buffer_info, path, trace_writer):
+    """receive a whole buffer described by buffer_info and store it in path.
+       When the connection supports it, packets are spliced straight into the
+       file (synchronously, falling back to user space for the rest of the
+       transfer if splice() is rejected). Otherwise every packet is received
+       back to back into one of the connection's reused receive buffers and
+       the file is written by trace_writer in the background. Either way the
+       file ends up holding all the packets in order, and a transfer cut
+       short leaves only the bytes actually received."""
+
+    # Read the struct fields once
+    num_packets = buffer_info.num_packets
+    regular_packet_size = buffer_info.regular_packet_size
+    last_packet_size = buffer_info.last_packet_size
+
+    # Calculate the size of the whole buffer (all packets are contiguous in the stream)
+    total_size = 0
+    if num_packets > 0:
+        total_size = (num_packets - 1) * regular_packet_size + last_packet_size
+
+    # Move the data to the file without copying it through user space
+    if conn.can_splice():
+        fd = open_trace_file(path, total_size)
+        try:
+            num_bytes_moved = conn.recv_into_file(fd, total_size)
+
+            # splice() is not supported, receive the rest through user space
+            if num_bytes_moved < total_size:
+                trace_writer.flush()
+                write_all(fd, conn.recv_exact_into_reused(total_size - num_bytes_moved))
+        except BaseException:
+            # Do not leave the preallocated size if the transfer was cut short
+            truncate_to_written(fd)
+            raise
+        finally:
+            os.close(fd)
+        return
+
+    data = conn.recv_exact_into_reused(total_size)
+
+    # Write bytes to file
+    trace_writer.write(path, data)
 
 
 if __name__ == "__main__":
@@ -129,90 +407,49 @@ if __name__ == "__main__":
         exit(0)
 
     print("Client connected!")
+    print("[Socket Info] Receive buffer: {} bytes".format(tcp_socket.recv_buffer_size()))
 
     # Aux variables
     i = 0
     bytes_to_recv = 0
 
+    # Background writer for the received buffers
+    trace_writer = TraceWriter()
+
     # Infinite operation
     # TODO: handle the interruption of this operation
-    while True:
-
-        print("Waiting for incoming buffers...")
-
-        # Get info about the next power buffer
-        try:
-            data = tcp_socket.recv_data(ct.sizeof(BufferInfo))
-        except KeyboardInterrupt:
-            print("Keyboard Interrupt")
-            exit(0)
-
-        buffer_info_c = BufferInfo.from_buffer_copy(data)
-        buffer_info = buffer_info_c.get_dict()
-
-        print("[{}] Power - Number of iterations: {}".format(i, buffer_info["num_packets"]))
-
-        with open("{}/traces/CON_{}.BIN".format(args.output_path, i), "wb") as binary_file:
-
-            # Convert to bytes
-            data = bytes()
-
-            # Process each received packet
-            for iter in range(buffer_info["num_packets"]):
-
-                # Calculate size to recieve
-                num_bytes_to_recv = buffer_info["regular_packet_size"] if iter < buffer_info["num_packets"] - 1 else buffer_info["last_packet_size"]
-                #print("iter: {} | bytes_to_recv: {}".format(iter, num_bytes_to_recv))
-                data += tcp_socket.recv_data(num_bytes_to_recv)
-
-            # Write bytes to file
-            binary_file.write(data)
-
-        # Get info about the next traces buffer
-        data = tcp_socket.recv_data(ct.sizeof(BufferInfo))
-        buffer_info_c = BufferInfo.from_buffer_copy(data)
-        buffer_info = buffer_info_c.get_dict()
-
-        print("[{}] Traces - Number of iterations: {}".format(i, buffer_info["num_packets"]))
-
-        with open("{}/traces/SIG_{}.BIN".format(args.output_path, i), "wb") as binary_file:
-
-            # Conver to bytes
-            data = bytes()
-
-            # Process each received packet
-            for iter in range(buffer_info["num_packets"]):
+    try:
+        while True:
 
-                # Calculate size to recieve
-                num_bytes_to_recv = buffer_info["regular_packet_size"] if iter < buffer_info["num_packets"] - 1 else buffer_info["last_packet_size"]
-                #print("iter: {} | bytes_to_recv: {}".format(iter, num_bytes_to_recv))
-                data = tcp_socket.recv_data(num_bytes_to_recv)
+            print("Waiting for incoming buffers...")
 
-            # Write bytes to file
-            binary_file.write(data)
+            # Get info about the next power buffer
+            try:
+                buffer_info = tcp_socket.recv_buffer_info()
+            except KeyboardInterrupt:
+                print("Keyboard Interrupt")
+                exit(0)
 
+            print("[{}] Power - Number of iterations: {}".format(i, buffer_info.num_packets))
 
-        # Get info about the next outputs buffer
-        data = tcp_socket.recv_data(ct.sizeof(BufferInfo))
-        buffer_info_c = BufferInfo.from_buffer_copy(data)
-        buffer_info = buffer_info_c.get_dict()
+            recv_buffer_to_file(tcp_socket, buffer_info, "{}/traces/CON_{}.BIN".format(args.output_path, i), trace_writer)
 
-        print("[{}] Online - Number of iterations: {}".format(i, buffer_info["num_packets"]))
+            # Get info about the next traces buffer
+            buffer_info = tcp_socket.recv_buffer_info()
 
-        with open("{}/outputs/online_{}.bin".format(args.output_path, i), "wb") as binary_file:
+            print("[{}] Traces - Number of iterations: {}".format(i, buffer_info.num_packets))
 
-            # Convert to bytes
-            data = bytes()
+            recv_buffer_to_file(tcp_socket, buffer_info, "{}/traces/SIG_{}.BIN".format(args.output_path, i), trace_writer)
 
-            for iter in range(buffer_info["num_packets"]):
+            # Get info about the next outputs buffer
+            buffer_info = tcp_socket.recv_buffer_info()
 
-                # Calculate size to recieve
-                num_bytes_to_recv = buffer_info["regular_packet_size"] if iter < buffer_info["num_packets"] - 1 else buffer_info["last_packet_size"]
-                #print("iter: {} | bytes_to_recv: {}".format(iter, num_bytes_to_recv))
-                data = tcp_socket.recv_data(num_bytes_to_recv)
+            print("[{}] Online - Number of iterations: {}".format(i, buffer_info.num_packets))
 
-            # Write bytes to file
-            binary_file.write(data)
+            recv_buffer_to_file(tcp_socket, buffer_info, "{}/outputs/online_{}.bin".format(args.output_path, i), trace_writer)
 
-        # Increment the count
-        i += 1
+            # Increment the count
+            i += 1
+    finally:
+        # Ensure every received buffer reaches the disk
+        trace_writer.close()
@@ -1,8 +1,8 @@
 from numpy.random import default_rng
 import numpy
 import argparse
-import struct
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 # Initiate the parser
 example_text = '''Example:
@@ -21,28 +21,25 @@ parser.add_argument("-s","--seed", metavar="x", help="set the seed for the rando
 # Read arguments from the command line
 args = parser.parse_args()
 
-if args.plot:
-    import matplotlib.pyplot as plt
+# The number of executions is stored as int32: base << (range - 1) must fit in it
+if not 1 <= args.range_executions <= 31:
+    parser.error("--range-executions must be between 1 and 31")
+if args.base_number_executions << (args.range_executions - 1) > numpy.iinfo(numpy.int32).max:
+    parser.error("--base-number-executions {} with --range-executions {} overflows a 32-bit integer".format(args.base_number_executions, args.range_executions))
 
-def kernel_inter_arrival_generator(ratio, num_elements, seed = 42):
-    # Create random number generator with a seed
-    rng = default_rng(seed)
+def kernel_inter_arrival_generator(ratio, num_elements, rng):
     # Create exponential rng with specific parameters
-    return rng.exponential(scale = 1/ratio, size = num_elements)  # scale == 1/lambda
+    return rng.exponential(scale = 1/ratio, size = num_elements).astype(numpy.float32)  # scale == 1/lambda
 
-def kernel_id_generator(id_range, num_elements, seed = 42):
-    # Create random number generator with a seed
-    rng = default_rng(seed)
-    # Create exponential rng with specific parameters
-    return rng.integers(low = id_range[0], high = id_range[1], size = num_elements)
+def kernel_id_generator(id_range, num_elements, rng):
+    # Create uniform integer rng with specific parameters
+    return rng.integers(low = id_range[0], high = id_range[1], size = num_elements, dtype = numpy.int32)
 
-def num_executions_generator(base, multiples, num_elements, seed = 42):
-    # Create random number generator with a seed
-    rng = default_rng(seed)
-    # Create exponential rng with specific parameters
-    list_values = rng.integers(low = 0, high = multiples, size = num_elements) # list of integers
-    # Convert to powers of 2 starting from "base"
-    return base * (2 ** list_values)
+def num_executions_generator(base, multiples, num_elements, rng):
+    # Create uniform integer rng with specific parameters
+    list_values = rng.integers(low = 0, high = multiples, size = num_elements, dtype = numpy.int32) # list of integers
+    # Convert to powers of 2 starting from "base" (base << n == base * 2**n)
+    return numpy.left_shift(numpy.int32(base), list_values, dtype = numpy.int32)
 
 # Save randomly generated initial conditions in files
 def save_generated_initial_conditions(inter_arrival_values, kernel_id_values, num_executions_values):
@@ -51,45 +48,57 @@ def save_generated_initial_conditions(inter_arrival_values, kernel_id_values, nu
     if not os.path.exists('initial_conditions'):
         os.makedirs('initial_conditions')
 
-    file = open("initial_conditions/inter_arrival.bin", "wb")
-    for value in inter_arrival_values:
-        file.write(struct.pack('f', value))
-    file.close()
-
-    file = open("initial_conditions/kernel_id.bin", "wb")
-    for value in kernel_id_values:
-        file.write(struct.pack('i', value))
-    file.close()
-
-    file = open("initial_conditions/num_executions.bin", "wb")
-    for value in num_executions_values:
-        file.write(struct.pack('i', value))
-    file.close()
+    # Ensure the stored dtypes (float32 and int32); no copy is made when the values already have them
+    file_values = [("initial_conditions/inter_arrival.bin", numpy.asarray(inter_arrival_values, dtype=numpy.float32)),
+                   ("initial_conditions/kernel_id.bin", numpy.asarray(kernel_id_values, dtype=numpy.int32)),
+                   ("initial_conditions/num_executions.bin", numpy.asarray(num_executions_values, dtype=numpy.int32))]
+
+    # Open every file up front and write each array's memory with raw os.write calls
+    fds = [os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644) for path, _ in file_values]
+    try:
+        for fd, (_, values) in zip(fds, file_values):
+            data = memoryview(values).cast('B')
+            # os.write() may write less than requested, loop until everything is written
+            num_bytes_written = 0
+            while num_bytes_written < len(data):
+                num_bytes_written += os.write(fd, data[num_bytes_written:])
+    finally:
+        for fd in fds:
+            os.close(fd)
 
     print("Initial conditions successfully saved into files.\n")
 
 ## Printing Functions ##
 
+# matplotlib.pyplot module, imported on first use
+_plt = None
+
+# Import matplotlib lazily (only when plotting) with the non-interactive Agg backend
+def get_pyplot():
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
+
 # Print kernels inter arrival dristributions
 def print_kernerl_inter_arrival_data(list_values):
 
-    inter_arrival_time = []
-    arrival_time = []
-    total_time = 0
+    # Accumulate in float64, the stored float32 values lose precision over long sums
+    inter_arrival_time = numpy.asarray(list_values)
+    arrival_time = numpy.cumsum(inter_arrival_time, dtype=numpy.float64)
 
-    # Time printing
-    for i, val in enumerate(list_values):
-        inter_arrival_time.append(val)
-        total_time += inter_arrival_time[i]
-        arrival_time.append(total_time)
+    print("\n\nTotal Time: {} | Mean Inter-Arrival Time: {}".format(arrival_time[-1], inter_arrival_time.mean(dtype=numpy.float64)))
 
-        #print("Inter-Arrival Time: {} | Arrival Time: {}".format(inter_arrival_time[i],round(arrival_time[i],3)))
-    print("\n\nTotal Time: {} | Mean Inter-Arrival Time: {}".format(arrival_time[-1],sum(inter_arrival_time)/len(inter_arrival_time)))
+    print("\n\nStandard Deviation: {} | Variance: {}\n\n".format(inter_arrival_time.std(dtype=numpy.float64), inter_arrival_time.var(dtype=numpy.float64)))
 
-    print("\n\nStandard Deviation: {} | Variance: {}\n\n".format(numpy.std(inter_arrival_time), numpy.var(inter_arrival_time)))
+    plt = get_pyplot()
 
-    # histogram
-    count, bins, ignored = plt.hist(list_values, 200, density=True)
+    # histogram (drawn as a single artist instead of one patch per bin)
+    count, bins = numpy.histogram(list_values, 200, density=True)
+    plt.stairs(count, bins, fill=True)
 
     plt.savefig('initial_conditions/inter_arrival_distribution.png')
     plt.close()
@@ -97,8 +106,11 @@ def print_kernerl_inter_arrival_data(list_values):
 # Print kernel id distributions
 def print_kernel_id_data(list_values, divs):
     print(list_values[0:15])
-    # histogram
-    count, bins, ignored = plt.hist(list_values, divs, density=True)
+    plt = get_pyplot()
+
+    # histogram (drawn as a single artist instead of one patch per bin)
+    count, bins = numpy.histogram(list_values, divs, density=True)
+    plt.stairs(count, bins, fill=True)
 
     plt.savefig('initial_conditions/kernel_id_distribution.png')
     plt.close()
@@ -106,8 +118,11 @@ def print_kernel_id_data(list_values, divs):
 # Print kernel number of executions dritributions
 def print_num_executions_data(list_values,divs):
     print(list_values[0:15])
-    # histogram
-    count, bins, ignored = plt.hist(list_values, divs, density=True)
+    plt = get_pyplot()
+
+    # histogram (drawn as a single artist instead of one patch per bin)
+    count, bins = numpy.histogram(list_values, divs, density=True)
+    plt.stairs(count, bins, fill=True)
 
     plt.savefig('initial_conditions/num_executions_distribution.png')
     plt.close()
@@ -127,10 +142,21 @@ print("Ratio of arrival (k/ms): {0}".format(ratio_arrival))
 print("Range of kernels: {0}".format(range_kernels))
 print("Base number of executions: {0}".format(base_num_executions))
 print("Range of executions: {0}".format(range_executions))
+print("Seed: {0}".format(args.seed))
+
+# Create a random number generator with a seed and spawn an independent stream for each generator
+rng = default_rng(args.seed)
+rng_inter_arrival, rng_kernel_id, rng_num_executions = rng.spawn(3)
+
+# Run the independent generators concurrently (numpy releases the GIL while drawing)
+with ThreadPoolExecutor(max_workers=3) as executor:
+    inter_arrival_future = executor.submit(kernel_inter_arrival_generator, ratio_arrival, num_elements, rng_inter_arrival)
+    kernel_id_future = executor.submit(kernel_id_generator, range_kernels, num_elements, rng_kernel_id)
+    num_executions_future = executor.submit(num_executions_generator, base_num_executions, range_executions, num_elements, rng_num_executions)
 
-inter_arrival_values = kernel_inter_arrival_generator(ratio_arrival, num_elements)
-kernel_id_values = kernel_id_generator(range_kernels, num_elements)
-num_executions_values = num_executions_generator(base_num_executions, range_executions, num_elements)
+inter_arrival_values = inter_arrival_future.result()
+kernel_id_values = kernel_id_future.result()
+num_executions_values = num_executions_future.result()
 
 save_generated_initial_conditions(inter_arrival_values, kernel_id_values, num_executions_values)
 